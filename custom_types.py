@@ -7,19 +7,29 @@ class RAGChunkAndSrc(pydantic.BaseModel):
     source_id: str = None
 
 
+class RAGChunkAndSrcBatch(pydantic.BaseModel):
+    items: list[RAGChunkAndSrc]
+
+
 class RAGUpsertResult(pydantic.BaseModel):
     ingested: int
 
 
 class RAGSearchResult(pydantic.BaseModel):
     contexts: list[str]
+    # One source per context, in the same order
     sources: list[str]
 
 
+class RAGBatchSearchResult(pydantic.BaseModel):
+    results: list[RAGSearchResult]
+
+
 class RAGQueryResult(pydantic.BaseModel):
     answer: str
     sources: list[str]
     num_contexts: int
+    num_truncated: int = 0
 
 
 # Output format types
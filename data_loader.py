@@ -1,17 +1,73 @@
-from openai import OpenAI
-from llama_index.readers.file import PDFReader, ImageReader, DocxReader
-from llama_index.core.node_parser import SentenceSplitter
+from openai import OpenAI, AsyncOpenAI
+from llama_index.readers.file import ImageReader, DocxReader
 from dotenv import load_dotenv
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pdf_chunking import splitter, split_text, count_pages, load_pdf_pages
+import asyncio
 import base64
+import blake3
+import diskcache
+import multiprocessing
+import os
+import threading
+import tiktoken
 
 load_dotenv()
 
 client = OpenAI()
 EMBED_MODEL = "text-embedding-3-large"
-EMBED_DIM = 3072
+# text-embedding-3 models support shortened (Matryoshka) embeddings via `dimensions`
+EMBED_DIM = 1024
+EMBED_MAX_TOKENS = 200_000
+EMBED_MAX_ITEMS = 2048
+EMBED_MAX_WORKERS = 8
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "./.embed_cache")
+VISION_MODEL = "gpt-4o-mini"
+VISION_MAX_CONCURRENCY = 8
+# Smaller PDFs are extracted in-process; worker startup would cost more than it saves
+PDF_PARALLEL_MIN_PAGES = 32
 
-splitter = SentenceSplitter(chunk_size=1000, chunk_overlap=200)
+encoding = tiktoken.get_encoding("cl100k_base")
+image_reader = ImageReader()
+docx_reader = DocxReader()
+
+# Worker processes must not be forked from the server: it holds live gRPC/HTTP client threads
+_mp_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# Created on first use and reused, so workers start (and import pdf_chunking) once per process
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+# Content-addressed embedding cache shared across sources and restarts
+_embed_cache = diskcache.Cache(EMBED_CACHE_DIR)
+
+
+def _get_max_workers(num_workers: int | None = None) -> int:
+    """Worker count for CPU-bound document processing"""
+    if num_workers is None:
+        num_workers = min(os.cpu_count() or 1, 4)
+    return max(1, num_workers)
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """Shared process pool for PDF extraction"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=_get_max_workers(), mp_context=_mp_context)
+        return _pdf_pool
+
+
+def _reset_pdf_pool(pool: ProcessPoolExecutor):
+    """Drop a broken pool so the next PDF starts fresh workers"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
 
 
 def get_file_type(path: str) -> str:
@@ -27,79 +83,107 @@ def get_file_type(path: str) -> str:
         raise ValueError(f"Unsupported file type: {ext}")
 
 
-def load_and_chunk_pdf(path: str):
-    """Load and chunk PDF documents"""
-    docs = PDFReader().load_data(file=path)
-    texts = [d.text for d in docs if getattr(d, "text", None)]
-    chunks = []
-    for t in texts:
-        if t and t.strip():
-            chunks.extend(splitter.split_text(t))
-    return chunks
+def load_and_chunk_pdf(path: str, num_workers: int | None = None):
+    """Load and chunk PDF documents, extracting page ranges in parallel for long files"""
+    n_pages = count_pages(path)
+
+    num_workers = min(_get_max_workers(num_workers), n_pages)
+    if num_workers <= 1 or n_pages < PDF_PARALLEL_MIN_PAGES:
+        page_chunks = load_pdf_pages(path, 0, n_pages)
+    else:
+        # A few contiguous ranges per worker balances uneven pages without reopening the PDF per page
+        n_ranges = min(n_pages, num_workers * 4)
+        bounds = [n_pages * i // n_ranges for i in range(n_ranges + 1)]
+        pool = _get_pdf_pool()
+        try:
+            ranges = pool.map(load_pdf_pages, [path] * n_ranges, bounds[:-1], bounds[1:])
+            page_chunks = [chunks for pages in ranges for chunks in pages]
+        except BrokenProcessPool:
+            _reset_pdf_pool(pool)
+            raise
+    return [c for chunks in page_chunks for c in chunks]
+
+
+def _vision_messages(img_data: bytes) -> list[dict]:
+    """Build the Vision API request for extracting text from an image"""
+    base64_image = base64.b64encode(img_data).decode('utf-8')
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text", 
+                    "text": "Extract all text content from this image. If there are tables, preserve their structure. If there are diagrams or charts, describe them in detail."
+                },
+                {
+                    "type": "image_url", 
+                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+                }
+            ]
+        }
+    ]
+
+
+def _read_image_text(path: str) -> list[str]:
+    """Extract text from an image with LlamaIndex ImageReader"""
+    docs = image_reader.load_data(file=path)
+    return [d.text for d in docs if getattr(d, "text", None)]
 
 
 def load_and_chunk_image(path: str):
     """Load and extract text from images using OCR"""
-    try:
-        # Try LlamaIndex ImageReader first
-        docs = ImageReader().load_data(file=path)
-        texts = [d.text for d in docs if getattr(d, "text", None)]
-        
-        # If no text extracted or empty, try OpenAI Vision API
-        if not texts or not any(t.strip() for t in texts):
-            print(f"Using Vision API for {path}")
-            with open(path, 'rb') as img_file:
-                img_data = img_file.read()
-            
-            # Use OpenAI Vision API for better extraction
-            base64_image = base64.b64encode(img_data).decode('utf-8')
+    # Sync entry point for load_and_chunk_file; must not be called from a running event loop
+    return asyncio.run(load_and_chunk_images([path]))[0]
+
+
+async def _ocr_image_async(path: str, vision_client: AsyncOpenAI, semaphore: asyncio.Semaphore) -> str:
+    """Extract text from an image with the Vision API without blocking the event loop"""
+    async with semaphore:
+        img_data = await asyncio.to_thread(Path(path).read_bytes)
+        response = await vision_client.chat.completions.create(
+            model=VISION_MODEL,
+            messages=_vision_messages(img_data),
+            max_tokens=2000
+        )
+    return response.choices[0].message.content
+
+
+async def load_and_chunk_images(paths: list[str], max_concurrency: int = VISION_MAX_CONCURRENCY) -> list[list[str]]:
+    """Load and chunk many images, overlapping their Vision API calls"""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _load(path: str, vision_client: AsyncOpenAI) -> list[str]:
+        try:
+            # Try LlamaIndex ImageReader first
+            texts = await asyncio.to_thread(_read_image_text, path)
             
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text", 
-                                "text": "Extract all text content from this image. If there are tables, preserve their structure. If there are diagrams or charts, describe them in detail."
-                            },
-                            {
-                                "type": "image_url", 
-                                "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=2000
-            )
-            texts = [response.choices[0].message.content]
-        
-        chunks = []
-        for t in texts:
-            if t and t.strip():
-                chunks.extend(splitter.split_text(t))
-        
-        return chunks if chunks else [f"[Image file: {Path(path).name} - No text extracted]"]
-        
-    except Exception as e:
-        print(f"Error processing image {path}: {e}")
-        return [f"[Image file: {Path(path).name} - Processing error: {str(e)}]"]
+            # If no text extracted or empty, try OpenAI Vision API
+            if not texts or not any(t.strip() for t in texts):
+                print(f"Using Vision API for {path}")
+                texts = [await _ocr_image_async(path, vision_client, semaphore)]
+            return [c for t in texts for c in split_text(t)]
+        except Exception as e:
+            print(f"Error processing image {path}: {e}")
+            return []
+
+    # The async client's connection pool is bound to this event loop, so it lives per call
+    async with AsyncOpenAI() as vision_client:
+        return await asyncio.gather(*[_load(p, vision_client) for p in paths])
 
 
 def load_and_chunk_word(path: str):
     """Load and chunk Word documents"""
     try:
-        docs = DocxReader().load_data(file=path)
+        docs = docx_reader.load_data(file=path)
         texts = [d.text for d in docs if getattr(d, "text", None)]
         chunks = []
         for t in texts:
             if t and t.strip():
-                chunks.extend(splitter.split_text(t))
-        return chunks if chunks else [f"[Empty Word document: {Path(path).name}]"]
+                chunks.extend(splitter.chunks(t))
+        return chunks
     except Exception as e:
         print(f"Error processing Word document {path}: {e}")
-        return [f"[Word document: {Path(path).name} - Processing error: {str(e)}]"]
+        return []
 
 
 def load_and_chunk_file(path: str):
@@ -116,13 +200,81 @@ def load_and_chunk_file(path: str):
         raise ValueError(f"Unsupported file type: {file_type}")
 
 
+def _batch(texts: list[str], max_tokens: int = EMBED_MAX_TOKENS, max_items: int = EMBED_MAX_ITEMS):
+    """Yield consecutive slices of texts that fit within the embedding request limits"""
+    batch = []
+    batch_tokens = 0
+    for t in texts:
+        n_tokens = len(encoding.encode(t, disallowed_special=()))
+        if batch and (batch_tokens + n_tokens > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(t)
+        batch_tokens += n_tokens
+    if batch:
+        yield batch
+
+
+def _embed_batch(batch: list[str]) -> list[list[float]]:
+    """Embed a single batch in one API call"""
+    response = client.embeddings.create(
+        model=EMBED_MODEL,
+        input=batch,
+        dimensions=EMBED_DIM,
+    )
+    return [item.embedding for item in response.data]
+
+
+def _embed_uncached(texts: list[str]) -> list[list[float]]:
+    """Embed texts via the API, batching large inputs concurrently"""
+    batches = list(_batch(texts))
+    if len(batches) == 1:
+        return _embed_batch(batches[0])
+    
+    # executor.map preserves batch order, so results line up with texts
+    with ThreadPoolExecutor(max_workers=min(EMBED_MAX_WORKERS, len(batches))) as executor:
+        results = executor.map(_embed_batch, batches)
+    return [vec for batch_vecs in results for vec in batch_vecs]
+
+
+def _cache_key(text: str) -> str:
+    """Cache key for a text under the current embedding model"""
+    return f"{EMBED_MODEL}:{EMBED_DIM}:{blake3.blake3(text.encode()).hexdigest()}"
+
+
 def embed_texts(texts: list[str]) -> list[list[float]]:
-    """Generate embeddings for text chunks"""
+    """Generate embeddings for text chunks, only calling the API for uncached texts"""
     if not texts:
         return []
     
-    response = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=texts,
-    )
-    return [item.embedding for item in response.data]
\ No newline at end of file
+    keys = [_cache_key(t) for t in texts]
+    cached = {k: v for k in set(keys) if (v := _embed_cache.get(k)) is not None}
+    
+    # Deduplicate misses so repeated chunks are embedded once
+    misses = {}
+    for k, t in zip(keys, texts):
+        if k not in cached and k not in misses:
+            misses[k] = t
+    if misses:
+        vecs = _embed_uncached(list(misses.values()))
+        for k, vec in zip(misses, vecs):
+            _embed_cache.set(k, vec)
+            cached[k] = vec
+    
+    return [cached[k] for k in keys]
+
+
+def embed_one(text: str) -> list[float]:
+    """Generate the embedding for a single text, such as a query"""
+    key = _cache_key(text)
+    vec = _embed_cache.get(key)
+    if vec is None:
+        response = client.embeddings.create(
+            model=EMBED_MODEL,
+            input=text,
+            dimensions=EMBED_DIM,
+        )
+        vec = response.data[0].embedding
+        _embed_cache.set(key, vec)
+    return vec
@@ -6,12 +6,46 @@ import inngest
 from dotenv import load_dotenv
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 from typing import Tuple
 import shutil
+import threading
+from functools import lru_cache
 
 load_dotenv()
 
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp"}
 
+# Shared session so polling reuses one keep-alive connection
+_http = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.1))
+_http.mount("http://", _http_adapter)
+_http.mount("https://", _http_adapter)
+
+# One background event loop for all handlers instead of asyncio.run per request
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, daemon=True, name="inngest-loop").start()
+
+
+class EventSendTimeout(RuntimeError):
+    """Sending an event to Inngest did not complete in time"""
+
+
+def _run_async(coro, timeout_s: float = 30.0):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    future = asyncio.run_coroutine_threadsafe(coro, _loop)
+    try:
+        return future.result(timeout=timeout_s)
+    except TimeoutError:
+        # Stop the coroutine instead of leaving it running on the shared loop
+        future.cancel()
+        # Distinct from TimeoutError, which callers treat as a slow function run
+        raise EventSendTimeout(f"Timed out after {timeout_s:.0f}s sending event to Inngest") from None
+
+
+@lru_cache(maxsize=1)
 def get_inngest_client() -> inngest.Inngest:
     """Get Inngest client instance"""
     return inngest.Inngest(app_id="rag_app", is_production=False)
@@ -22,12 +56,17 @@ def save_uploaded_file(file) -> Path:
     uploads_dir = Path("uploads")
     uploads_dir.mkdir(parents=True, exist_ok=True)
     
-    # Get filename from the file object
-    file_path = Path(file.name)
+    # Gradio passes a path string for type="filepath", older versions a tempfile object
+    src = getattr(file, "name", file)
+    file_path = Path(src)
     dest_path = uploads_dir / file_path.name
     
-    # Copy file to uploads directory
-    shutil.copy2(file.name, dest_path)
+    # Hardlink into uploads when on the same filesystem, otherwise copy
+    dest_path.unlink(missing_ok=True)
+    try:
+        os.link(src, dest_path)
+    except OSError:
+        shutil.copy2(src, dest_path)
     
     return dest_path
 
@@ -47,6 +86,34 @@ async def send_rag_ingest_event(file_path: Path) -> str:
     return file_path.name
 
 
+async def send_rag_ingest_images_event(file_paths: list[Path]) -> list[str]:
+    """Send one batched ingestion event for several images"""
+    client = get_inngest_client()
+    await client.send(
+        inngest.Event(
+            name="rag/ingest_images",
+            data={
+                "file_paths": [str(p.resolve()) for p in file_paths],
+                "source_ids": [p.name for p in file_paths],
+            },
+        )
+    )
+    return [p.name for p in file_paths]
+
+
+async def send_uploads(file_paths: list[Path]) -> None:
+    """Send ingestion events, batching images so their OCR runs concurrently"""
+    images = [p for p in file_paths if p.suffix.lower() in IMAGE_EXTENSIONS]
+    others = [p for p in file_paths if p.suffix.lower() not in IMAGE_EXTENSIONS]
+    if len(images) == 1:
+        others.append(images.pop())
+    sends = [send_rag_ingest_event(p) for p in others]
+    if images:
+        sends.append(send_rag_ingest_images_event(images))
+    await asyncio.gather(*sends)
+
+
+@lru_cache(maxsize=1)
 def _inngest_api_base() -> str:
     """Get Inngest API base URL"""
     return os.getenv("INNGEST_API_BASE", "http://127.0.0.1:8288/v1")
@@ -56,19 +123,25 @@ def fetch_runs(event_id: str) -> list[dict]:
     """Fetch runs for a given event ID"""
     url = f"{_inngest_api_base()}/events/{event_id}/runs"
     try:
-        resp = requests.get(url, timeout=5)
+        resp = _http.get(url, timeout=5)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         return data.get("data", [])
     except Exception as e:
         print(f"Error fetching runs: {e}")
         return []
 
 
-def wait_for_run_output(event_id: str, timeout_s: float = 120.0, poll_interval_s: float = 0.5) -> dict:
-    """Wait for run output with polling"""
+def wait_for_run_output(
+    event_id: str,
+    timeout_s: float = 120.0,
+    poll_interval_s: float = 0.1,
+    max_poll_interval_s: float = 2.0,
+) -> dict:
+    """Wait for run output, polling with exponential backoff"""
     start = time.time()
     last_status = None
+    interval = poll_interval_s
     while True:
         runs = fetch_runs(event_id)
         if runs:
@@ -79,32 +152,33 @@ def wait_for_run_output(event_id: str, timeout_s: float = 120.0, poll_interval_s
                 return run.get("output") or {}
             if status in ("Failed", "Cancelled"):
                 raise RuntimeError(f"Function run {status}")
-        if time.time() - start > timeout_s:
+        elapsed = time.time() - start
+        if elapsed > timeout_s:
             raise TimeoutError(f"Timed out waiting for run output (last status: {last_status})")
-        time.sleep(poll_interval_s)
+        time.sleep(min(interval, timeout_s - elapsed))
+        interval = min(interval * 2, max_poll_interval_s)
 
 
-def upload_file(file) -> str:
-    """Handle file upload"""
-    if file is None:
+def upload_file(files) -> str:
+    """Handle file uploads"""
+    if not files:
         return "⚠️ Please upload a file first."
+    if not isinstance(files, list):
+        files = [files]
     
     try:
-        file_path = save_uploaded_file(file)
-        event_id = asyncio.run(send_rag_ingest_event(file_path))
+        file_paths = [save_uploaded_file(f) for f in files]
+        _run_async(send_uploads(file_paths))
         
-        # Wait a bit for processing
-        time.sleep(1)
-        
-        file_size = file_path.stat().st_size / 1024  # KB
+        file_details = "\n".join(
+            f"- `{p.name}` (`{p.suffix}`, `{p.stat().st_size / 1024:.2f} KB`)" for p in file_paths
+        )
         return f"""✅ **Successfully uploaded and processing!**
 
 **File Details:**
-- Name: `{file_path.name}`
-- Type: `{file_path.suffix}`
-- Size: `{file_size:.2f} KB`
+{file_details}
 
-The document is being processed and will be ready for querying shortly. You can now switch to the **Query Documents** tab to ask questions!"""
+The documents are being processed and will be ready for querying shortly. You can now switch to the **Query Documents** tab to ask questions!"""
     except Exception as e:
         return f"❌ **Error uploading file:** {str(e)}\n\nPlease make sure all services are running:\n1. FastAPI server\n2. Inngest dev server\n3. Qdrant database"
 
@@ -132,7 +206,7 @@ def query_documents(question: str, top_k: int, output_format: str) -> Tuple[str,
     
     try:
         # Send query event
-        event_id = asyncio.run(send_rag_query_event(question.strip(), int(top_k), output_format))
+        event_id = _run_async(send_rag_query_event(question.strip(), int(top_k), output_format))
         
         # Wait for result
         output = wait_for_run_output(event_id, timeout_s=60.0)
@@ -151,6 +225,8 @@ def query_documents(question: str, top_k: int, output_format: str) -> Tuple[str,
         
         return f"### 💡 Answer\n\n{answer}", sources_text
         
+    except EventSendTimeout as e:
+        return f"❌ **Error:** {str(e)}\n\n**Troubleshooting:**\n1. Check if Inngest dev server is running\n2. Verify FastAPI server is running", ""
     except TimeoutError:
         return "⏱️ **Request timed out.** The query is taking longer than expected. Please try again with fewer chunks or a simpler question.", ""
     except Exception as e:
@@ -199,15 +275,16 @@ with gr.Blocks(
                     """
                     ### Upload Your Documents
                     
-                    Upload PDF files, Word documents, or images containing text.
+                    Upload PDF files, Word documents, or images containing text. Multiple images are processed together.
                     """
                 )
             
             with gr.Row():
                 with gr.Column(scale=1):
                     file_input = gr.File(
-                        label="📁 Choose a file",
+                        label="📁 Choose files",
                         file_types=[".pdf", ".docx", ".doc", ".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp"],
+                        file_count="multiple",
                         type="filepath"
                     )
                     
@@ -7,12 +7,33 @@ from dotenv import load_dotenv
 import uuid
 import os
 import datetime
-from data_loader import load_and_chunk_file, embed_texts
-from vector_db import QdrantStorage
-from custom_types import RAGQueryResult, RAGSearchResult, RAGUpsertResult, RAGChunkAndSrc, OutputFormat
+import asyncio
+import orjson
+import threading
+import tiktoken
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from data_loader import load_and_chunk_file, load_and_chunk_images, embed_texts, embed_one, EMBED_DIM
+from vector_db import QdrantStorage, FaissStorage
+from custom_types import RAGQueryResult, RAGSearchResult, RAGUpsertResult, RAGChunkAndSrc, RAGChunkAndSrcBatch, RAGBatchSearchResult, OutputFormat
 
 load_dotenv()
 
+_store = None
+_store_lock = threading.Lock()
+
+# Questions answered per LLM call in batch queries, kept small to stay well inside the context window
+QUERY_BATCH_SIZE = 8
+
+# Output tokens budgeted per answer, and gpt-4o-mini's completion limit for a whole batch
+ANSWER_MAX_TOKENS = 2048
+MODEL_MAX_OUTPUT_TOKENS = 16384
+
+# Context tokens sent to the LLM per question; later chunks are dropped past this budget
+MAX_CONTEXT_TOKENS = 6000
+encoder = tiktoken.encoding_for_model("gpt-4o-mini")
+
 inngest_client = inngest.Inngest(
     app_id="rag_app",
     logger=logging.getLogger("uvicorn"),
@@ -20,6 +41,42 @@ inngest_client = inngest.Inngest(
     serializer=inngest.PydanticSerializer()
 )
 
+def _get_store() -> QdrantStorage | FaissStorage:
+    """Shared vector storage selected by VECTOR_STORE, created on first use"""
+    global _store
+    if _store is None:
+        # Batch searches call this from several threads; only one may create the collection
+        with _store_lock:
+            if _store is None:
+                if os.getenv("VECTOR_STORE", "qdrant").lower() == "faiss":
+                    _store = FaissStorage(path=os.getenv("FAISS_INDEX_PATH", "./faiss_index"), dim=EMBED_DIM)
+                else:
+                    _store = QdrantStorage(dim=EMBED_DIM)
+    return _store
+
+
+def _upsert_chunks(items: list[RAGChunkAndSrc]) -> RAGUpsertResult:
+    """Embed chunks from one or more sources and upsert them into the vector store"""
+    chunks = [c for item in items for c in item.chunks]
+    if not chunks:
+        return RAGUpsertResult(ingested=0)
+    
+    vecs = embed_texts(chunks)
+    ids = []
+    payloads = []
+    for item in items:
+        for i, chunk in enumerate(item.chunks):
+            ids.append(str(uuid.uuid5(uuid.NAMESPACE_URL, f"{item.source_id}:{i}")))
+            payloads.append({"source": item.source_id, "text": chunk})
+    _get_store().upsert(ids, vecs, payloads)
+    return RAGUpsertResult(ingested=len(chunks))
+
+
+async def _upsert_chunks_async(items: list[RAGChunkAndSrc]) -> RAGUpsertResult:
+    """Run _upsert_chunks off the event loop; embedding and vector store writes block"""
+    return await asyncio.to_thread(_upsert_chunks, items)
+
+
 @inngest_client.create_function(
     fn_id="RAG: Ingest File",
     trigger=inngest.TriggerEvent(event="rag/ingest_file"),
@@ -35,27 +92,48 @@ inngest_client = inngest.Inngest(
 )
 async def rag_ingest_file(ctx: inngest.Context):
     """Ingest files of multiple formats: PDF, Word, Images"""
-    def _load(ctx: inngest.Context) -> RAGChunkAndSrc:
-        file_path = ctx.event.data["file_path"]
-        source_id = ctx.event.data.get("source_id", file_path)
-        chunks = load_and_chunk_file(file_path)
+    async def _load(file_path: str, source_id: str) -> RAGChunkAndSrc:
+        # Off the event loop: parsing is blocking and image OCR runs its own loop
+        chunks = await asyncio.to_thread(load_and_chunk_file, file_path)
+        if not chunks:
+            ctx.logger.warning(f"No text extracted from {file_path}; skipping embedding")
         return RAGChunkAndSrc(chunks=chunks, source_id=source_id)
 
-    def _upsert(chunks_and_src: RAGChunkAndSrc) -> RAGUpsertResult:
-        chunks = chunks_and_src.chunks
-        source_id = chunks_and_src.source_id
-        
-        if not chunks:
-            return RAGUpsertResult(ingested=0)
-        
-        vecs = embed_texts(chunks)
-        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{i}")) for i in range(len(chunks))]
-        payloads = [{"source": source_id, "text": chunks[i]} for i in range(len(chunks))]
-        QdrantStorage().upsert(ids, vecs, payloads)
-        return RAGUpsertResult(ingested=len(chunks))
-
-    chunks_and_src = await ctx.step.run("load-and-chunk", lambda: _load(ctx), output_type=RAGChunkAndSrc)
-    ingested = await ctx.step.run("embed-and-upsert", lambda: _upsert(chunks_and_src), output_type=RAGUpsertResult)
+    file_path = ctx.event.data["file_path"]
+    source_id = ctx.event.data.get("source_id", file_path)
+
+    chunks_and_src = await ctx.step.run("load-and-chunk", _load, file_path, source_id, output_type=RAGChunkAndSrc)
+    ingested = await ctx.step.run("embed-and-upsert", _upsert_chunks_async, [chunks_and_src], output_type=RAGUpsertResult)
+    return ingested.model_dump()
+
+
+@inngest_client.create_function(
+    fn_id="RAG: Ingest Images",
+    trigger=inngest.TriggerEvent(event="rag/ingest_images"),
+    throttle=inngest.Throttle(
+        limit=2, 
+        period=datetime.timedelta(minutes=1)
+    ),
+)
+async def rag_ingest_images(ctx: inngest.Context):
+    """Ingest a batch of images, running their OCR requests concurrently"""
+    async def _load(file_paths: list[str], source_ids: list[str]) -> RAGChunkAndSrcBatch:
+        all_chunks = await load_and_chunk_images(file_paths)
+        for path, chunks in zip(file_paths, all_chunks):
+            if not chunks:
+                ctx.logger.warning(f"No text extracted from {path}; skipping embedding")
+        return RAGChunkAndSrcBatch(items=[
+            RAGChunkAndSrc(chunks=chunks, source_id=source_id)
+            for chunks, source_id in zip(all_chunks, source_ids)
+        ])
+
+    file_paths = ctx.event.data["file_paths"]
+    source_ids = ctx.event.data.get("source_ids") or [Path(p).name for p in file_paths]
+    if len(source_ids) != len(file_paths):
+        raise inngest.NonRetriableError(f"Got {len(source_ids)} source_ids for {len(file_paths)} file_paths")
+
+    batch = await ctx.step.run("load-and-chunk", _load, file_paths, source_ids, output_type=RAGChunkAndSrcBatch)
+    ingested = await ctx.step.run("embed-and-upsert", _upsert_chunks_async, batch.items, output_type=RAGUpsertResult)
     return ingested.model_dump()
 
 
@@ -85,25 +163,63 @@ def get_user_instruction(output_format: str) -> str:
     return instructions.get(output_format, instructions["short"])
 
 
+def _search_vector(query_vec: list[float], top_k: int = 5) -> RAGSearchResult:
+    """Retrieve the chunks closest to a query embedding"""
+    found = _get_store().search(query_vec, top_k)
+    return RAGSearchResult(contexts=found["contexts"], sources=found["sources"])
+
+
+def _search(question: str, top_k: int = 5) -> RAGSearchResult:
+    """Embed a question and retrieve its closest chunks"""
+    return _search_vector(embed_one(question), top_k)
+
+
+@lru_cache(maxsize=256)
+def _search_for_run(run_id: str, question: str, top_k: int) -> RAGSearchResult:
+    """Search once per run so replays cite the same contexts the answer was built from"""
+    return _search(question, top_k)
+
+
+def _build_context_block(contexts: list[str], max_tokens: int = MAX_CONTEXT_TOKENS) -> tuple[str, int]:
+    """Join contexts in rank order up to the token budget; returns the block and how many were used"""
+    lines = []
+    total = 0
+    for c in contexts:
+        line = f"- {c}"
+        n_tokens = len(encoder.encode(line, disallowed_special=()))
+        if lines and total + n_tokens > max_tokens:
+            break
+        lines.append(line)
+        total += n_tokens
+    return "\n\n".join(lines), len(lines)
+
+
+def _cited_sources(search: RAGSearchResult, num_used: int) -> list[str]:
+    """Distinct sources of the contexts actually sent to the LLM, in rank order"""
+    return list(dict.fromkeys(search.sources[:num_used]))
+
+
+def _openai_adapter() -> ai.openai.Adapter:
+    """OpenAI adapter for step.ai.infer"""
+    return ai.openai.Adapter(
+        auth_key=os.getenv("OPENAI_API_KEY"),
+        model="gpt-4o-mini"
+    )
+
+
 @inngest_client.create_function(
     fn_id="RAG: Query Documents",
     trigger=inngest.TriggerEvent(event="rag/query_documents_ai")
 )
 async def rag_query_documents_ai(ctx: inngest.Context):
     """Query documents with customizable output formats"""
-    def _search(question: str, top_k: int = 5) -> RAGSearchResult:
-        query_vec = embed_texts([question])[0]
-        store = QdrantStorage()
-        found = store.search(query_vec, top_k)
-        return RAGSearchResult(contexts=found["contexts"], sources=found["sources"])
-
     question = ctx.event.data["question"]
     top_k = int(ctx.event.data.get("top_k", 5))
     output_format = ctx.event.data.get("output_format", "short")
 
-    found = await ctx.step.run("embed-and-search", lambda: _search(question, top_k), output_type=RAGSearchResult)
-
-    context_block = "\n\n".join(f"- {c}" for c in found.contexts)
+    # Not a checkpointed step: search off the event loop, reused when Inngest replays this run
+    found = await asyncio.to_thread(_search_for_run, ctx.run_id, question, top_k)
+    context_block, num_used = _build_context_block(found.contexts)
     user_content = (
         "Use the following context to answer the question.\n\n"
         f"Context:\n{context_block}\n\n"
@@ -111,16 +227,11 @@ async def rag_query_documents_ai(ctx: inngest.Context):
         f"Instructions: {get_user_instruction(output_format)}"
     )
 
-    adapter = ai.openai.Adapter(
-        auth_key=os.getenv("OPENAI_API_KEY"),
-        model="gpt-4o-mini"
-    )
-
     res = await ctx.step.ai.infer(
         "llm-answer",
-        adapter=adapter,
+        adapter=_openai_adapter(),
         body={
-            "max_tokens": 2048,
+            "max_tokens": ANSWER_MAX_TOKENS,
             "temperature": 0.2,
             "messages": [
                 {"role": "system", "content": get_system_prompt(output_format)},
@@ -130,9 +241,108 @@ async def rag_query_documents_ai(ctx: inngest.Context):
     )
 
     answer = res["choices"][0]["message"]["content"].strip()
-    return {"answer": answer, "sources": found.sources, "num_contexts": len(found.contexts)}
+    return RAGQueryResult(
+        answer=answer,
+        sources=_cited_sources(found, num_used),
+        num_contexts=num_used,
+        num_truncated=len(found.contexts) - num_used,
+    ).model_dump()
+
+
+@inngest_client.create_function(
+    fn_id="RAG: Query Documents Batch",
+    trigger=inngest.TriggerEvent(event="rag/query_batch_ai")
+)
+async def rag_query_batch(ctx: inngest.Context):
+    """Answer several questions, sharing one system prompt per LLM call"""
+    def _search_all(questions: list[str], top_k: int) -> RAGBatchSearchResult:
+        # One embedding request for every question, then the searches run concurrently
+        vecs = embed_texts(questions)
+        with ThreadPoolExecutor(max_workers=min(8, len(vecs)) or 1) as executor:
+            results = list(executor.map(lambda vec: _search_vector(vec, top_k), vecs))
+        return RAGBatchSearchResult(results=results)
+
+    questions = [q for q in ctx.event.data["questions"] if q and q.strip()]
+    top_k = int(ctx.event.data.get("top_k", 5))
+    output_format = ctx.event.data.get("output_format", "short")
+
+    found = await ctx.step.run("embed-and-search", _search_all, questions, top_k, output_type=RAGBatchSearchResult)
+
+    system_prompt = (
+        f"{get_system_prompt(output_format)} "
+        "You will receive several numbered questions, each with its own context. "
+        "Answer each question using only its own context. "
+        'Respond with a JSON object of the form {"answers": ["answer to Q1", "answer to Q2", ...]} '
+        "with exactly one answer per question, in order."
+    )
+
+    async def _answer(start: int, stop: int) -> list[dict]:
+        batch_questions = questions[start:stop]
+        batch_found = found.results[start:stop]
+
+        sections = []
+        num_used = []
+        for i, (question, search) in enumerate(zip(batch_questions, batch_found), 1):
+            context_block, used = _build_context_block(search.contexts)
+            num_used.append(used)
+            sections.append(f"Q{i}: {question}\nContext{i}:\n{context_block}")
+        user_content = (
+            "\n\n".join(sections)
+            + f"\n\nInstructions: {get_user_instruction(output_format)}"
+        )
+
+        res = await ctx.step.ai.infer(
+            f"llm-answer-{start}-{stop}",
+            adapter=_openai_adapter(),
+            body={
+                "max_tokens": min(ANSWER_MAX_TOKENS * len(batch_questions), MODEL_MAX_OUTPUT_TOKENS),
+                "temperature": 0.2,
+                "response_format": {"type": "json_object"},
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_content}
+                ]
+            }
+        )
+
+        choice = res["choices"][0]
+        error = None
+        if choice.get("finish_reason") == "length":
+            # Truncated JSON cannot be parsed; retry the halves so each gets its own output budget
+            if len(batch_questions) > 1:
+                mid = start + len(batch_questions) // 2
+                return await _answer(start, mid) + await _answer(mid, stop)
+            error = "Answer exceeded the model's output token limit."
+
+        try:
+            answers = orjson.loads(choice["message"]["content"]).get("answers", [])
+        except (orjson.JSONDecodeError, AttributeError, TypeError):
+            answers = None
+        if not isinstance(answers, list):
+            # A bare string would otherwise be indexed into single characters
+            answers = []
+            error = error or "Model did not return a parseable answer."
+
+        results = []
+        for i, (question, search) in enumerate(zip(batch_questions, batch_found)):
+            answer = answers[i] if i < len(answers) and isinstance(answers[i], str) else "No answer generated."
+            results.append({
+                "question": question,
+                "answer": answer.strip(),
+                "sources": _cited_sources(search, num_used[i]),
+                "num_contexts": num_used[i],
+                "num_truncated": len(search.contexts) - num_used[i],
+                "error": error,
+            })
+        return results
+
+    results = []
+    for start in range(0, len(questions), QUERY_BATCH_SIZE):
+        results.extend(await _answer(start, min(start + QUERY_BATCH_SIZE, len(questions))))
+
+    return {"results": results}
 
 
 app = FastAPI()
 
-inngest.fast_api.serve(app, inngest_client, [rag_ingest_file, rag_query_documents_ai])
+inngest.fast_api.serve(app, inngest_client, [rag_ingest_file, rag_ingest_images, rag_query_documents_ai, rag_query_batch])
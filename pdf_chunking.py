@@ -0,0 +1,38 @@
+"""PDF text extraction and chunking, kept light enough for worker processes to import quickly"""
+from semantic_text_splitter import TextSplitter
+import pypdfium2 as pdfium
+
+splitter = TextSplitter.from_tiktoken_model("gpt-4o-mini", capacity=1000, overlap=200)
+
+
+def split_text(text: str) -> list[str]:
+    """Split a single text into chunks"""
+    if not text or not text.strip():
+        return []
+    return splitter.chunks(text)
+
+
+def count_pages(path: str) -> int:
+    """Number of pages in a PDF"""
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def load_pdf_pages(path: str, start: int, stop: int) -> list[list[str]]:
+    """Extract and chunk a range of PDF pages"""
+    # Each worker opens its own document once per range; pdfium handles are not shareable
+    pdf = pdfium.PdfDocument(path)
+    try:
+        page_chunks = []
+        for index in range(start, stop):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            page_chunks.append(split_text(textpage.get_text_bounded()))
+            textpage.close()
+            page.close()
+        return page_chunks
+    finally:
+        pdf.close()
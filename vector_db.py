@@ -1,37 +1,272 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+import atexit
+import os
+import threading
+import uuid
+import numpy as np
+import orjson
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import (
+    VectorParams,
+    Distance,
+    PointStruct,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    QuantizationSearchParams,
+)
+
+try:
+    import faiss
+except ImportError:  # only required when VECTOR_STORE=faiss
+    faiss = None
+
+
+def _collect_results(payloads):
+    # sources[i] is the source of contexts[i], so callers can cite only the contexts they use
+    contexts = []
+    sources = []
+
+    for payload in payloads:
+        payload = payload or {}
+        text = payload.get("text", "")
+        source = payload.get("source", "")
+        if text:
+            contexts.append(text)
+            sources.append(source)
+
+    return {"contexts": contexts, "sources": sources}
 
 
 class QdrantStorage:
-    def __init__(self, url="http://localhost:6333", collection="docs", dim=3072):
-        self.client = QdrantClient(url=url, timeout=30)
+    def __init__(self, url="http://localhost:6333", collection="docs", dim=1024, prefer_grpc=True):
+        # gRPC (port 6334) keeps one persistent HTTP/2 channel open
+        self.client = QdrantClient(url=url, timeout=30, prefer_grpc=prefer_grpc)
         self.collection = collection
         if not self.client.collection_exists(self.collection):
             self.client.create_collection(
                 collection_name=self.collection,
-                vectors_config=VectorParams(size=dim, distance=Distance.COSINE),
+                # Full-precision vectors stay on disk for rescoring; int8 copies are searched in RAM
+                vectors_config=VectorParams(size=dim, distance=Distance.COSINE, on_disk=True),
+                quantization_config=ScalarQuantization(
+                    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True),
+                ),
             )
+        else:
+            size = self.client.get_collection(self.collection).config.params.vectors.size
+            if size != dim:
+                raise ValueError(
+                    f"Collection '{self.collection}' has {size}-dim vectors but {dim} were requested; "
+                    "delete and re-ingest the collection or use a different collection name"
+                )
 
-    def upsert(self, ids, vectors, payloads):
+    def upsert(self, ids, vectors, payloads, batch_size: int = 256, max_workers: int = 4):
         points = [PointStruct(id=ids[i], vector=vectors[i], payload=payloads[i]) for i in range(len(ids))]
-        self.client.upsert(self.collection, points=points)
+        batches = [points[i:i + batch_size] for i in range(0, len(points), batch_size)]
+        if len(batches) <= 1:
+            for batch in batches:
+                self.client.upsert(self.collection, points=batch)
+            return
+        # Overlap the network round trip of one batch with serialization of the next
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            list(executor.map(lambda batch: self.client.upsert(self.collection, points=batch), batches))
 
     def search(self, query_vector, top_k: int = 5):
         results = self.client.search(
             collection_name=self.collection,
             query_vector=query_vector,
             with_payload=True,
-            limit=top_k
+            limit=top_k,
+            search_params=SearchParams(quantization=QuantizationSearchParams(rescore=True)),
         )
-        contexts = []
-        sources = set()
-
-        for r in results:
-            payload = getattr(r, "payload", None) or {}
-            text = payload.get("text", "")
-            source = payload.get("source", "")
-            if text:
-                contexts.append(text)
-                sources.add(source)
-
-        return {"contexts": contexts, "sources": list(sources)}
\ No newline at end of file
+        return _collect_results(getattr(r, "payload", None) for r in results)
+
+
+class _ReadWriteLock:
+    """Lets any number of readers in at once, or a single writer; waiting writers go first"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class FaissStorage:
+    """In-process FAISS index with the same interface as QdrantStorage.
+
+    Vectors live in an exact flat index until there are enough of them to train
+    the IVF-PQ index, which happens on a background thread; until it is swapped in
+    the flat index keeps serving searches. Changes are written to disk at most once
+    per save_delay seconds and when the process exits, so an upsert never waits on
+    serializing the whole store.
+    """
+
+    def __init__(self, path="./faiss_index", dim=1024, nlist=4096, m=64, nbits=8, nprobe=32, save_delay=30.0):
+        if faiss is None:
+            raise ImportError("faiss is required for FaissStorage; install faiss-cpu")
+        # PQ splits each vector into m equal sub-vectors, so m must divide dim
+        if dim % m:
+            raise ValueError(f"PQ sub-quantizer count m={m} must divide dim={dim}")
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.nprobe = nprobe
+        self.save_delay = save_delay
+        # Index and payloads share one file so a single os.replace keeps them in sync
+        self.store_path = Path(path) / "store.npz"
+        # Searches share _lock; upserts and the index swap take it exclusively
+        self._lock = _ReadWriteLock()
+        # Upserts made while the IVF-PQ index trains, replayed onto it before the swap
+        self._pending = None
+        self._save_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._dirty = False
+        self._save_timer = None
+
+        if self.store_path.exists():
+            with np.load(self.store_path) as data:
+                self.index = faiss.deserialize_index(data["index"])
+                payloads = orjson.loads(data["payloads"].tobytes())
+            if self.index.d != dim:
+                raise ValueError(
+                    f"FAISS index at '{path}' has {self.index.d}-dim vectors but {dim} were requested; "
+                    "delete it and re-ingest or use a different path"
+                )
+            self.payloads = {int(k): v for k, v in payloads.items()}
+            self._set_nprobe(self.index)
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+            self.payloads = {}
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _to_int_id(point_id):
+        # FAISS ids are int64; fold the UUID point ids into the non-negative range
+        return uuid.UUID(str(point_id)).int >> 65
+
+    def _as_matrix(self, vectors):
+        # Normalized vectors make inner product equal to cosine similarity
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        faiss.normalize_L2(matrix)
+        return matrix
+
+    def _set_nprobe(self, index):
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.nprobe
+
+    def _needs_training(self):
+        return not isinstance(self.index, faiss.IndexIVF) and self.index.ntotal >= max(self.nlist, 2 ** self.nbits) * 39
+
+    def _train(self):
+        try:
+            # Upserts only append to _pending from here on, so a shared lock is enough to copy the vectors
+            with self._lock.read():
+                ids = faiss.vector_to_array(self.index.id_map)
+                vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+            quantizer = faiss.IndexFlatIP(self.dim)
+            index = faiss.IndexIVFPQ(quantizer, self.dim, self.nlist, self.m, self.nbits, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+            index.add_with_ids(vectors, ids)
+            self._set_nprobe(index)
+            with self._lock.write():
+                for pending_ids, pending_matrix in self._pending:
+                    index.remove_ids(pending_ids)
+                    index.add_with_ids(pending_matrix, pending_ids)
+                self.index = index
+        finally:
+            # On failure the flat index stays in use and the next upsert retries training
+            with self._lock.write():
+                self._pending = None
+        self._schedule_save()
+
+    def _schedule_save(self):
+        with self._state_lock:
+            self._dirty = True
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def flush(self):
+        """Write the index and payloads to disk if they changed since the last save"""
+        with self._save_lock:
+            with self._state_lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+            try:
+                with self._lock.read():
+                    index_bytes = faiss.serialize_index(self.index)
+                    payloads = orjson.dumps({str(k): v for k, v in self.payloads.items()})
+                self.store_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.store_path.with_name(self.store_path.name + ".tmp")
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, index=index_bytes, payloads=np.frombuffer(payloads, dtype=np.uint8))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.store_path)
+            except Exception:
+                self._schedule_save()
+                raise
+
+    def upsert(self, ids, vectors, payloads):
+        int_ids = np.array([self._to_int_id(i) for i in ids], dtype=np.int64)
+        matrix = self._as_matrix(vectors)
+        with self._lock.write():
+            # Replace existing points with the same id, matching Qdrant upsert semantics
+            self.index.remove_ids(int_ids)
+            self.index.add_with_ids(matrix, int_ids)
+            self.payloads.update(zip(int_ids.tolist(), payloads))
+            if self._pending is not None:
+                self._pending.append((int_ids, matrix))
+            start_training = self._pending is None and self._needs_training()
+            if start_training:
+                self._pending = []
+        if start_training:
+            threading.Thread(target=self._train, name="faiss-train", daemon=True).start()
+        self._schedule_save()
+
+    def search(self, query_vector, top_k: int = 5):
+        matrix = self._as_matrix(query_vector)
+        with self._lock.read():
+            if self.index.ntotal == 0:
+                return _collect_results([])
+            _, result_ids = self.index.search(matrix, top_k)
+            return _collect_results(self.payloads.get(i) for i in result_ids[0] if i != -1)